@@ -3,8 +3,8 @@
 """
 
 from sani.api import Sani
-from sani.core import Filter, Op, SaniTree
+from sani.core import Filter, Op, SaniTree, SyncFilter
 
 __version__ = "0.1.0"
 
-__all__ = ["Sani", "SaniTree", "Filter", "Op"]
+__all__ = ["Sani", "SaniTree", "Filter", "SyncFilter", "Op"]
@@ -1,7 +1,8 @@
-from typing import Any, Awaitable, Callable, List, Optional
+import inspect
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Union
 
 from sani.core import SaniTree
-from sani.filters import UnitFilter
+from sani.filters import _is_async_callable
 
 
 class Sani:
@@ -10,16 +11,54 @@ class Sani:
     def __init__(
         self,
         tree: SaniTree,
-        catch: Optional[Callable[[Exception], Awaitable[None]]] = None,
+        catch: Optional[Callable[[Exception], Union[Awaitable[None], None]]] = None,
     ) -> None:
         self.tree = tree
         self.catch = catch
+        # catch 可以是异步函数或普通函数，在这里判断一次。
+        self._catch_is_async = catch is not None and _is_async_callable(catch)
+        self._caught_pool: List[List[Exception]] = []
+        # 提前编译，使第一次触发事件时不必等待编译。
+        tree.compile()
 
     async def emit(self, event: Any):
         """触发事件。"""
-        caught: List[Exception] = []
-        await self.tree.emit_and({"event": event}, UnitFilter(), caught)
+        # 复用异常列表；并发触发时各自从池中取出，互不干扰。
+        pool = self._caught_pool
+        caught = pool.pop() if pool else []
+        try:
+            await self.tree.compile_event()(event, caught)
+            if caught:
+                await self._report(caught)
+        finally:
+            caught.clear()
+            pool.append(caught)
 
+    async def emit_many(self, events: Iterable[Any]):
+        """依次触发多个事件。
+
+        等价于对每个事件依次调用 [`emit`][sani.api.Sani.emit]，事件之间的顺序不变，
+        但省去了每个事件获取异常列表等的开销，适合一次性处理大量事件。
+        """
+        pool = self._caught_pool
+        caught = pool.pop() if pool else []
+        tree = self.tree
+        try:
+            for event in events:
+                await tree.compile_event()(event, caught)
+                if caught:
+                    try:
+                        await self._report(caught)
+                    finally:
+                        caught.clear()
+        finally:
+            caught.clear()
+            pool.append(caught)
+
+    async def _report(self, caught: List[Exception]):
+        """将记录下来的异常交给 catch。"""
         if self.catch:
             for err in reversed(caught):
-                await self.catch(err)
+                res = self.catch(err)
+                if self._catch_is_async or inspect.isawaitable(res):
+                    await res  # type: ignore
@@ -0,0 +1,375 @@
+"""
+# SaniTree 编译器
+
+SaniTree 的结构在构建完成后就固定下来，而事件的分派却要一遍遍地遍历它。
+编译器将 SaniTree 展开为一组专用的协程函数：每条边对应一个函数，
+过滤器与子节点的分派方式都在编译时确定，运行时不再需要遍历字典或判断子节点表是否为空。
+
+编译结果的行为与 [`SaniTree.emit_root`][sani.core.SaniTree.emit_root] 一致。
+通常不需要直接使用本模块，见 [`SaniTree.compile`][sani.core.SaniTree.compile]。
+"""
+from __future__ import annotations
+
+import textwrap
+from typing import Any, Awaitable, Callable, ClassVar, Iterable, Optional, cast
+
+from sani.core import EdgeList, Filter, LayeredCtx, SaniTree, eager_gather
+from sani.filters import FuncFilter, RaiseFilter, TypeFilter, _is_async_callable
+
+Dispatcher = Callable[[dict[str, Any], list[Exception]], Awaitable[None]]
+"""编译得到的分派函数，接收事件上下文与异常列表。"""
+
+EventDispatcher = Callable[[Any, list[Exception]], Awaitable[None]]
+"""编译得到的分派函数，接收事件本身与异常列表，按需创建事件上下文。"""
+
+
+def compile_tree(tree: SaniTree) -> tuple[Dispatcher, EventDispatcher]:
+    """将 SaniTree 编译为分派函数，两者分别接收事件上下文与事件本身。"""
+    return _Compiler().compile(tree)
+
+
+MAX_INLINE_DEPTH = 8
+"""同一个函数中最多内联的边数，避免生成的代码缩进过深。"""
+
+
+class _Compiler:
+    ns: dict[str, Any]
+    funcs: list[str]
+    edges: dict[tuple[int, int], str]
+    filters: dict[int, str]
+    indexes: list[_TypeIndex]
+    # 已分配名称、尚未生成函数的边。逐个取出处理，而不是递归编译子树，
+    # 这样再深的树也不会超出递归深度限制。
+    pending: list[tuple[str, Filter, SaniTree]]
+    # 不内联的边，见 branches。
+    shared: set[tuple[int, int]]
+
+    def __init__(self) -> None:
+        self.ns = {
+            "root": LayeredCtx.root,
+            "layer": LayeredCtx.layer,
+            "gather": eager_gather,
+            "type": type,
+            "isinstance": isinstance,
+            "Exception": Exception,
+            "dict": dict,
+        }
+        self.funcs = []
+        self.edges = {}
+        self.filters = {}
+        self.indexes = []
+        self.pending = []
+        self.shared = set()
+
+    def compile(self, tree: SaniTree) -> tuple[Dispatcher, EventDispatcher]:
+        edges = self.and_edges(tree.ands) + self.or_edges(tree.ors)
+        if len(edges) == 1:
+            # 不在调用者的 contextvars 上下文中执行过滤器；多条边时 gather 已经为各边复制了上下文。
+            name = self.edge(*edges[0])
+            body = f"    await gather({name}(ctx, ev, caught))\n"
+        else:
+            body = self.dispatch("ctx", edges, "    ")
+        self.funcs.append(
+            f'async def _root(ctx, caught):\n    ev = ctx["event"]\n{body}'
+        )
+        self.funcs.append(
+            f"async def _emit(ev, caught):\n{self.guard(edges)}"
+            f"    ctx = root(ev)\n{body}"
+        )
+        while self.pending:
+            name, filter, node = self.pending.pop()
+            body = self.body(filter, node, "    ", 0)
+            self.funcs.append(f"async def {name}(ctx, ev, caught):\n{body}")
+        # 所有函数都定义在 _make 中，过滤器等对象作为 _make 的参数传入，
+        # 在生成的函数中以闭包变量（LOAD_DEREF）访问，比全局变量的查找更快。
+        source = (
+            f"def _make({', '.join(self.ns)}):\n"
+            + textwrap.indent("\n".join(self.funcs), "    ")
+            + "    return locals()\n"
+        )
+        namespace: dict[str, Any] = {}
+        exec(compile(source, "<sani>", "exec"), namespace)
+        funcs = namespace["_make"](**self.ns)
+        for index in self.indexes:
+            index.bind(funcs)
+        return funcs["_root"], funcs["_emit"]
+
+    def guard(self, edges: list[tuple[Filter, SaniTree]]) -> str:
+        """生成 `_emit` 开头的类型检查。
+
+        如果根节点之后只有可以按类型跳过的边，先检查是否有边可能通过，
+        都不可能通过的事件直接返回，不必创建事件上下文。
+        """
+        if not edges:
+            return "    return\n"
+        if not all(map(_indexable, edges)):
+            return ""
+        live = _TypeIndex(())
+        live.targets = [(filter.target_type, True) for filter, _ in edges]  # type: ignore
+        self.ns["_live"] = live
+        return (
+            "    t = type(ev)\n"
+            "    if not (_live[t] if ev.__class__ is t else _live.select(ev)):\n"
+            "        return\n"
+        )
+
+    def filter(self, filter: Any) -> str:
+        """为过滤器（或其中的函数）分配全局名称。"""
+        name = self.filters.get(id(filter))
+        if name is None:
+            name = self.filters[id(filter)] = f"_f{len(self.filters)}"
+            self.ns[name] = filter
+        return name
+
+    def call(self, filter: Filter, indent: str) -> str:
+        """生成调用过滤器、将结果存入 `res` 的语句。
+
+        同步过滤器直接调用 `sync_filter`。`FuncFilter` 直接调用其中的函数，省去一层协程：
+        异步函数直接等待；普通函数只在返回可等待对象时才等待。
+        """
+        if type(filter) is FuncFilter:
+            name = self.filter(filter.func)
+            if _is_async_callable(filter.func):
+                return f"{indent}res = await {name}(ctx)\n"
+            return (
+                f"{indent}res = {name}(ctx)\n"
+                f"{indent}if res is not None and not isinstance(res, dict):\n"
+                f"{indent}    res = await res\n"
+            )
+        name = self.filter(filter)
+        if not filter.is_async:
+            return f"{indent}res = {name}.sync_filter(ctx)\n"
+        return f"{indent}res = await {name}.filter(ctx)\n"
+
+    def edge(self, filter: Filter, node: SaniTree) -> str:
+        """为以 AND 方式进入的边分配函数名称，函数稍后生成。共享的子树只编译一次。"""
+        key = (id(filter), id(node))
+        name = self.edges.get(key)
+        if name is None:
+            name = self.edges[key] = f"_a{len(self.edges)}"
+            self.pending.append((name, filter, node))
+        return name
+
+    def body(self, filter: Filter, node: SaniTree, indent: str, depth: int) -> str:
+        """生成以 AND 方式进入边的语句。
+
+        输入上下文为 `ctx`，事件本身为 `ev`，后者在整个分派过程中不变，由各函数按位置传递，
+        不必每次从上下文中查找。`depth` 为已经内联的层数。
+        """
+        inner = indent + "    "
+        depth += 1
+        if _plain_type_filter(filter):
+            # 检查之后没有要做的事时，仍需生成语句，使所在的函数或分支不为空。
+            check = self.type_check(cast(TypeFilter, filter), node, indent, depth)
+            return check or f"{indent}pass\n"
+        raises = type(filter) is RaiseFilter
+        if raises:
+            # RaiseFilter 只会重新抛出上下文中的异常，直接转入出错的分支，不必真正抛出再捕获。
+            lines = [f'{indent}if "error" in ctx:\n', f'{inner}e = ctx["error"]\n']
+        else:
+            lines = [f"{indent}try:\n", self.call(filter, inner)]
+            if node.ands or node.ors:
+                # 新的上下文层也在 try 中创建：过滤器返回的不是字典时，错误同样交给出错的分支。
+                lines.append(f"{inner}if res is not None:\n")
+                lines.append(f"{inner}    sub = {_SUB}\n")
+            lines.append(f"{indent}except Exception as e:\n")
+        # 出错：以 AND 传给 catch/and 子节点，以 OR 传给 or 子节点。
+        err = (
+            self.and_edges(node.catches)
+            + self.and_edges(node.ands)
+            + self.or_edges(node.ors)
+        )
+        if not node.catches:
+            lines.append(f"{inner}caught.append(e)\n")
+        if err:
+            lines.append(f'{inner}err = layer(ctx, {{"error": e}})\n')
+            # 出错的分支不内联：and 子节点在两个分支中都会进入，内联会使代码量随深度指数增长。
+            lines.append(self.dispatch("err", err, inner, MAX_INLINE_DEPTH))
+        lines.append(f"{inner}return\n")
+
+        if raises:  # 不抛出时 RaiseFilter 总是返回 None
+            lines.append(self.dispatch("ctx", self.and_edges(node.ors), indent, depth))
+            return "".join(lines)
+        ok, empty = self.branches(node)
+        if ok:
+            lines.append(f"{indent}if res is not None:\n")
+            lines.append(self.dispatch("sub", ok, inner, depth))
+            if empty:
+                lines.append(f"{indent}else:\n")
+                lines.append(self.dispatch("ctx", empty, inner, depth))
+        elif empty:
+            lines.append(f"{indent}if res is None:\n")
+            lines.append(self.dispatch("ctx", empty, inner, depth))
+
+        return "".join(lines)
+
+    def type_check(
+        self, filter: TypeFilter, node: SaniTree, indent: str, depth: int
+    ) -> str:
+        """生成内联的类型检查。检查不会出错，通过时上下文不变，因此不需要 try 与新的上下文层。"""
+        target = self.filter(filter.target_type)
+        check = f"type(ev) is {target} or isinstance(ev, {target})"
+        inner = indent + "    "
+        ok, empty = self.branches(node)
+        if ok:
+            lines = [f"{indent}if {check}:\n", self.dispatch("ctx", ok, inner, depth)]
+            if empty:
+                lines.append(f"{indent}else:\n")
+                lines.append(self.dispatch("ctx", empty, inner, depth))
+            return "".join(lines)
+        if empty:
+            return f"{indent}if not ({check}):\n" + self.dispatch(
+                "ctx", empty, inner, depth
+            )
+        return ""
+
+    def branches(
+        self, node: SaniTree
+    ) -> tuple[list[tuple[Filter, SaniTree]], list[tuple[Filter, SaniTree]]]:
+        """过滤器通过与不通过时分别需要进入的边。
+
+        通过（非空结果）时，以 AND 传给 and 子节点，以 OR 传给 or 子节点；
+        不通过（空结果）时，以 AND 传给 or 子节点。
+        or 子节点的 and 子节点因此在两个分支中都可能进入，这些边不内联，只生成一次函数，
+        否则两个分支各内联一份，代码量会随深度成倍增长。
+        """
+        ok = self.and_edges(node.ands) + self.or_edges(node.ors)
+        empty = self.and_edges(node.ors)
+        if empty:
+            self.shared.update(
+                (id(f), id(child)) for f, child in self.or_edges(node.ors)
+            )
+        return ok, empty
+
+    @staticmethod
+    def and_edges(children: EdgeList[SaniTree]) -> list[tuple[Filter, SaniTree]]:
+        """以 AND 传给子节点时需要进入的边。进入后什么都不会发生的边被略去。"""
+        return [
+            (filter, child)
+            for filter, child, _ in children
+            if not _noop((filter, child))
+        ]
+
+    @staticmethod
+    def or_edges(children: EdgeList[SaniTree]) -> list[tuple[Filter, SaniTree]]:
+        """以 OR 传给子节点时需要进入的边，即跳过子节点自身，以 AND 传给它的 and 子节点。"""
+        return [
+            (filter, grandchild)
+            for _, child, _ in children
+            for filter, grandchild, _ in child.ands
+            if not _noop((filter, grandchild))
+        ]
+
+    def dispatch(
+        self,
+        ctx: str,
+        edges: list[tuple[Filter, SaniTree]],
+        indent: str,
+        depth: int = 0,
+    ) -> str:
+        """生成进入一组边并等待的语句。
+
+        只有一条边时，直接把它内联在当前位置：这一定是所在分支的最后一条语句，
+        因此可以重新绑定 `ctx`，其中的 `return` 也不会跳过其他语句。
+        这样一串首尾相接的过滤器会被合并到同一个函数中，省去逐层创建协程的开销。
+        """
+        if not edges:
+            return ""
+        if sum(map(_indexable, edges)) >= 2:
+            return self.dispatch_indexed(ctx, edges, indent)
+        if len(edges) == 1:
+            filter, child = edges[0]
+            if depth < MAX_INLINE_DEPTH and (id(filter), id(child)) not in self.shared:
+                rebind = f"{indent}ctx = {ctx}\n" if ctx != "ctx" else ""
+                return rebind + self.body(filter, child, indent, depth)
+            return f"{indent}await {self.edge(filter, child)}({ctx}, ev, caught)\n"
+        calls = [
+            f"{self.edge(filter, child)}({ctx}, ev, caught)" for filter, child in edges
+        ]
+        return f"{indent}await gather({', '.join(calls)})\n"
+
+    def dispatch_indexed(
+        self, ctx: str, edges: list[tuple[Filter, SaniTree]], indent: str
+    ) -> str:
+        """生成按事件类型查表、只进入可能通过的边的语句。"""
+        index = _TypeIndex(
+            (
+                filter.target_type if _indexable((filter, child)) else None,  # type: ignore
+                self.edge(filter, child),
+            )
+            for filter, child in edges
+        )
+        name = f"_t{len(self.indexes)}"
+        self.ns[name] = index
+        self.indexes.append(index)
+        return (
+            f"{indent}t = type(ev)\n"
+            f"{indent}sel = {name}[t] if ev.__class__ is t else {name}.select(ev)\n"
+            f"{indent}if sel:\n"
+            f"{indent}    await gather(*[f({ctx}, ev, caught) for f in sel])\n"
+        )
+
+
+# 过滤器返回非空结果后，向下传递的上下文。空字典不产生新的一层；
+# 其他的结果（包括不是字典的返回值）交给 LayeredCtx.layer，由它检查类型。
+_SUB = "layer(ctx, res) if res or res.__class__ is not dict else ctx"
+
+
+def _plain_type_filter(filter: Filter) -> bool:
+    """是否为目标类型没有自定义 `__instancecheck__` 的 `TypeFilter`，这样的检查只取决于事件的类型，且不会出错。"""
+    return type(filter) is TypeFilter and type(filter.target_type) is type  # type: ignore
+
+
+def _noop(edge: tuple[Filter, SaniTree]) -> bool:
+    """进入这条边是否什么都不会发生：内联的类型检查之后没有子节点。"""
+    filter, child = edge
+    return _plain_type_filter(filter) and not child.ands and not child.ors
+
+
+def _indexable(edge: tuple[Filter, SaniTree]) -> bool:
+    """能否按事件类型跳过这条边。
+
+    要求过滤器满足 `_plain_type_filter`，且子节点没有 or 子节点，从而过滤器不通过时什么都不用做。
+    """
+    filter, child = edge
+    return _plain_type_filter(filter) and not child.ors
+
+
+class _TypeIndex(dict[type, tuple[Any, ...]]):
+    """事件类型到需要进入的边的映射，按需填充。
+
+    `targets` 按原有顺序记录每条边的目标类型与对应函数，目标类型为 `None` 的边总是需要进入。
+
+    缓存的事件类型最多 `MAX_SIZE` 个，超出时丢弃最早的，不会因为动态创建的事件类型无限增长，
+    也不会让这些类型一直存活。
+    """
+
+    MAX_SIZE: ClassVar[int] = 256
+
+    names: list[tuple[Optional[type], str]]
+    targets: list[tuple[Optional[type], Any]]
+
+    def __init__(self, names: Iterable[tuple[Optional[type], str]]) -> None:
+        super().__init__()
+        self.names = list(names)
+        self.targets = []
+
+    def bind(self, ns: dict[str, Any]) -> None:
+        """编译完成后，将边的函数名替换为函数本身。"""
+        self.targets = [(target, ns[name]) for target, name in self.names]
+
+    def __missing__(self, t: type) -> tuple[Any, ...]:
+        if len(self) >= self.MAX_SIZE:
+            del self[next(iter(self))]
+        sel = self[t] = tuple(
+            f for target, f in self.targets if target is None or issubclass(t, target)
+        )
+        return sel
+
+    def select(self, event: Any) -> tuple[Any, ...]:
+        """`event.__class__` 与 `type(event)` 不同时，结果不能按类型缓存，逐个检查。"""
+        return tuple(
+            f
+            for target, f in self.targets
+            if target is None or isinstance(event, target)
+        )
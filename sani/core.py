@@ -57,8 +57,8 @@ Sani 核心对外提供一系列接口。出于性能优化或这其他的目的
 
 - [`Filter`][sani.core.Filter] 应该正确实现 `__eq__` 和 `__hash__`。一般来说，经过
   [`@dataclass(eq=True, frozen=True)` ][dataclasses.dataclass] 修饰即可。
-- [`Filter`][sani.core.Filter] 的 [`filter`][sani.core.Filter.filter] 方法在调用时，
-  `context` 参数会复制一份。这意味着 `filter` 方法内部对事件上下文的修改不会影响到外部。
+- [`Filter`][sani.core.Filter] 的 [`filter`][sani.core.Filter.filter] 方法的 `context`
+  参数是只读的，并且可能在多个过滤器之间共享。对事件上下文的修改应通过返回值完成。
 - [`Filter`][sani.core.Filter] 的 [`filter`][sani.core.Filter.filter] 方法的 `context`
   参数的 `"event"` 键指向事件的原始数据，`"error"` 键指向过滤器中发生的异常。
   过滤器的逻辑不应该设置或覆盖它们。
@@ -67,6 +67,11 @@ Sani 核心对外提供一系列接口。出于性能优化或这其他的目的
 - [`SaniTree`][sani.core.SaniTree] 中，处理一个事件时，
   某个过滤器的最大可能调用次数为从根节点到该过滤器所在边的路径数。
   由于过滤器路径上较前的过滤器可能会把事件拦截，因此该过滤器的实际调用次数可能小于该值。
+- 过滤器中发生的异常，如果该过滤器所在的边之后连接有 `CATCH` 过滤器，则视为已处理，
+  不会被记录；否则会被记录下来（见 [`Sani`][sani.api.Sani] 的 `catch` 参数）。
+  是否已处理只取决于树的结构，与 `CATCH` 过滤器的返回值无关。
+- 过滤器在 [`contextvars`][contextvars] 上下文的副本中执行，如同各自运行在独立的 Task 中：
+  过滤器对上下文变量的修改对其之后的过滤器可见，但不影响其他分支上的过滤器，也不影响触发事件的调用者。
 
 ---
 # 使用核心 API
@@ -77,9 +82,25 @@ from __future__ import annotations
 
 import abc
 import asyncio
-import copy as cp
-from enum import Enum, auto
-from typing import Any, Generic, Iterable, Optional, TypeVar, final
+import types
+from contextvars import Context, copy_context
+from enum import IntEnum
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Coroutine,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+    final,
+)
 
 
 class Filter(abc.ABC):
@@ -116,6 +137,9 @@ class Filter(abc.ABC):
 
     `CATCH` 过滤器会在之前的过滤器调用中发生异常时被调用。`CATCH` 过滤器可以继续向后连接其他过滤器，
     以分别处理不同类型的异常。
+    一旦某个过滤器之后连接有 `CATCH` 过滤器，其中发生的异常就视为已经处理。
+    如果 `CATCH` 过滤器不能处理某种异常，可以以 `OR` 连接 [`RaiseFilter`][sani.filters.RaiseFilter]
+    将异常重新抛出。
 
     ---
     ## 事件上下文
@@ -126,7 +150,8 @@ class Filter(abc.ABC):
     事件上下文中的 `"event"` 键指向事件的原始数据，`"error"` 键（如果存在）指向过滤器中发生的异常。
     这两个键由 Sani 的核心约定规定，过滤器的逻辑不应该设置或覆盖它们。
 
-    事件上下文在过滤器路径中传递时，会在每个过滤器处复制一份。这意味着过滤器内部对事件上下文的修改无法影响到外部。
+    事件上下文在过滤器路径中传递时，以 [`LayeredCtx`][sani.core.LayeredCtx] 的形式逐层叠加，
+    同一个事件上下文可能被多个过滤器共享，因此它是只读的，尝试修改会引发 `TypeError`。
     对事件上下文的修改，应该通过返回值来完成，见 [`filter`][sani.core.Filter.filter]。
 
     例如，在上一节的过滤器路径中，如果 `func1` 中发生了异常，那么 `func2` 收到的上下文是这样的：
@@ -150,24 +175,45 @@ class Filter(abc.ABC):
 
     Sani 推荐将过滤器实现为 [`dataclass`][dataclasses]，这样可以自动实现 `__eq__` 与 `__hash__` 方法。
 
-    以[`TypeFilter`][sani.filters.TypeFilter]为例：
+    以[`TypeFilter`][sani.filters.TypeFilter]为例（省略了驻留等细节）：
 
     ```python
     @dataclass(eq=True, frozen=True)
-    class TypeFilter(Filter):
+    class TypeFilter(SyncFilter):
         target_type: type
-        __slots__ = ("target_type",)
+        __slots__ = ("target_type", "_hash")
+
+        def __post_init__(self) -> None:
+            object.__setattr__(self, "_hash", hash((self.target_type,)))
+
+        def __hash__(self) -> int:
+            return self._hash
 
-        async def filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
-            if isinstance(context["event"], self.target_type):
+        def sync_filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
+            event = context["event"]
+            # 精确匹配时跳过 isinstance 对 MRO 的查找。
+            if type(event) is self.target_type or isinstance(event, self.target_type):
                 return {}
             else:
                 return None
     ```
 
     通过 `@dataclass(eq=True, frozen=True)`，自动实现了 `__eq__` 与 `__hash__` 方法。
+
+    过滤器的 `__hash__` 会在构建 SaniTree 时被频繁调用。由于过滤器是不可变的，
+    可以在构造时计算哈希值并缓存，由显式定义的 `__hash__` 直接返回（dataclass 不会替换它），
+    Sani 的内置过滤器即是这样做的。
+
+    类型检查不需要等待任何东西，因此 `TypeFilter` 继承 [`SyncFilter`][sani.core.SyncFilter]，
+    实现同步的 `sync_filter`，而不是异步的 `filter`。
     """
 
+    is_async: ClassVar[bool] = True
+    """`filter` 是否需要等待。为 `False` 时，Sani 会直接调用同步的 `sync_filter`，见 [`SyncFilter`][sani.core.SyncFilter]。"""
+
+    # 不为内置过滤器引入 __dict__；未声明 __slots__ 的子类仍然会有 __dict__。
+    __slots__ = ()
+
     def __eq__(self, _: object) -> bool:
         raise NotImplementedError("Filter 必须指定有效的 __eq__ 实现！")
 
@@ -187,6 +233,34 @@ class Filter(abc.ABC):
         pass
 
 
+class SyncFilter(Filter):
+    """
+    # 同步过滤器
+
+    许多过滤器（例如类型检查、简单的条件判断）在执行中不需要等待任何东西。
+    这样的过滤器可以继承 `SyncFilter`，实现同步的 [`sync_filter`][sani.core.SyncFilter.sync_filter] 方法。
+
+    Sani 在分派事件时会直接调用 `sync_filter`，省去创建和等待协程的开销。
+    `filter` 方法由 `SyncFilter` 提供；如果子类覆盖了它，则会被当作普通的异步过滤器。
+    """
+
+    is_async: ClassVar[bool] = False
+
+    __slots__ = ()
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.is_async = cls.filter is not SyncFilter.filter
+
+    @abc.abstractmethod
+    def sync_filter(self, context: dict[str, Any], /) -> Optional[dict[str, Any]]:
+        """同步版本的 [`filter`][sani.core.Filter.filter]，参数与返回值的含义相同。"""
+        pass
+
+    async def filter(self, context: dict[str, Any], /) -> Optional[dict[str, Any]]:
+        return self.sync_filter(context)
+
+
 @final
 class SaniTree:
     """
@@ -195,23 +269,40 @@ class SaniTree:
     （待补充）
     """
 
-    ands: dict[Filter, CowRef[SaniTree]]
-    ors: dict[Filter, CowRef[SaniTree]]
-    catches: dict[Filter, CowRef[SaniTree]]
+    ands: EdgeList[SaniTree]
+    ors: EdgeList[SaniTree]
+    catches: EdgeList[SaniTree]
+    # (ands, ors, catches)，以 Op 的取值为下标。
+    _ch: tuple[EdgeList[SaniTree], ...]
+    # 是否没有任何子节点，由 add_path 维护。
+    _leaf: bool
+    # 本节点的子节点表被修改的次数。
+    _version: int
+    # (检查时的 _generation, 编译时树中各节点及其 _version, 接收上下文的分派函数, 接收事件的分派函数)
+    _compiled: Optional[tuple[int, tuple[tuple[SaniTree, int], ...], Any, Any]]
 
-    __slots__ = ("ands", "ors", "catches")
+    # 任何节点被修改都会使其增加。未变化时编译结果一定有效，不必逐个检查节点。
+    _generation: ClassVar[int] = 0
+
+    __slots__ = ("ands", "ors", "catches", "_ch", "_leaf", "_version", "_compiled")
 
     def __init__(self) -> None:
-        self.ands = {}
-        self.ors = {}
-        self.catches = {}
+        self.ands = EdgeList()
+        self.ors = EdgeList()
+        self.catches = EdgeList()
+        self._ch = (self.ands, self.ors, self.catches)
+        self._leaf = True
+        self._version = 0
+        self._compiled = None
 
     def copy(self) -> SaniTree:
         """（待补充）"""
         tree = SaniTree()
-        tree.ands = {fl: child.copy() for fl, child in self.ands.items()}
-        tree.ors = {fl: child.copy() for fl, child in self.ors.items()}
-        tree.catches = {fl: child.copy() for fl, child in self.catches.items()}
+        tree.ands, tree.ors, tree.catches = tree._ch = tuple(
+            EdgeList([(fl, child, False) for fl, child, _ in edges])
+            for edges in self._ch
+        )
+        tree._leaf = self._leaf
         return tree
 
     __copy__ = copy
@@ -220,27 +311,84 @@ class SaniTree:
         self, path: Iterable[tuple[Op, Filter, Optional[SaniTree]]]
     ) -> SaniTree:
         """添加一条过滤器路径。"""
-        curr = CowRef(self, True)
+        curr, owned, slot = self, True, (self, self.ands, 0)
         for op, filter, branch in path:
-            children = (
-                curr.ref().ands
-                if op is Op.AND
-                else (curr.ref().ors if op is Op.OR else curr.ref().catches)
-            )
-            if filter in children:
-                child = children[filter]
-                curr = child.mut()
-                if curr is not child:
-                    children[filter] = curr
-            else:
-                curr = CowRef(branch, False) if branch else CowRef(SaniTree(), True)
-                children[filter] = curr
+            if not owned:  # 修改共享的子节点之前，先复制一份
+                curr = curr.copy()
+                parent, edges, i = slot
+                edges[i] = (edges[i][0], curr, True)
+                parent._touch()
+            children = curr._ch[op]
+            i = children.find(filter)
+            if i < 0:
+                i = len(children)
+                children.add(filter, branch or SaniTree(), branch is None)
+                curr._leaf = False
+                curr._touch()
+            slot = (curr, children, i)
+            _, curr, owned = children[i]
         return self
 
+    def _touch(self) -> None:
+        """记录本节点的子节点表被修改。"""
+        self._version += 1
+        SaniTree._generation += 1
+
+    def compile(self) -> Callable[[dict[str, Any], list[Exception]], Awaitable[None]]:
+        """将树编译为专用的分派函数，其行为与 [`emit_root`][sani.core.SaniTree.emit_root] 一致。
+
+        编译结果会被缓存，直到树中的节点被修改（例如添加了新的路径）。
+        """
+        return self._compile()[2]
+
+    def compile_event(self) -> Callable[[Any, list[Exception]], Awaitable[None]]:
+        """与 [`compile`][sani.core.SaniTree.compile] 相同，但分派函数直接接收事件本身。
+
+        如果根节点之后只有类型过滤器，不可能通过任何一个的事件会直接返回，不会创建事件上下文。
+        """
+        return self._compile()[3]
+
+    def _compile(self) -> tuple[int, tuple[tuple[SaniTree, int], ...], Any, Any]:
+        compiled = self._compiled
+        generation = SaniTree._generation
+        if compiled is not None and compiled[0] != generation:
+            # 有节点被修改过，但不一定是这棵树中的节点：逐个检查编译时记下的节点。
+            if all(node._version == version for node, version in compiled[1]):
+                compiled = self._compiled = (generation, *compiled[1:])
+            else:
+                compiled = None
+        if compiled is None:
+            from sani.compiler import compile_tree
+
+            nodes = tuple((node, node._version) for node in self._nodes())
+            compiled = self._compiled = (generation, nodes, *compile_tree(self))
+        return compiled
+
+    def _nodes(self) -> list[SaniTree]:
+        """树中的所有节点，每个节点只出现一次。"""
+        seen = {id(self)}
+        nodes = [self]
+        for node in nodes:
+            for edges in node._ch:
+                for _, child, _ in edges:
+                    if id(child) not in seen:
+                        seen.add(id(child))
+                        nodes.append(child)
+        return nodes
+
     # 实现细节：
-    # - ctx 隔离，向下传递时创建新的副本。
+    # - ctx 只读，向下传递时以 LayeredCtx 叠加修改，不复制。
     # - emit 函数不应修改 self。
     # - emit 函数不应抛出 Exception。
+    # - 各 emit 函数将待执行的 (节点, ctx, 过滤器) 交给 _run 逐层执行；
+    #   只有挂起了的过滤器才为其子树另开协程，各分支互不等待。
+
+    async def emit_root(self, ctx: dict[str, Any], caught: list[Exception], /):
+        """以根节点的身份处理事件。
+        等价于以返回空字典的过滤器（如 `UnitFilter`）调用 `emit_and`，但省去过滤器的调用。"""
+        items: list[_Item] = []
+        self._forward(ctx, items)
+        await _run(items, caught)
 
     async def emit_and(
         self, ctx: dict[str, Any], filter: Filter, caught: list[Exception], /
@@ -248,106 +396,375 @@ class SaniTree:
         """正常执行过滤器。
         非空结果以 AND 传给 and 子节点，以 OR 传给 or 子节点。
         空结果以 AND 传给 or 子节点。
-        如果检测到错误，以 CATCH 传给 and/or 子节点，以 AND 传给 catch 子节点。"""
-        try:
-            res = await filter.filter(ctx)
-            if res is not None:  # 过滤器返回非空
-                ands = (
-                    child.ref().emit_and(ctx | res, filter, caught)
-                    for filter, child in self.ands.items()
-                )
-                ors = (
-                    child.ref().emit_or(ctx | res, caught)
-                    for child in self.ors.values()
-                )
-                await asyncio.gather(*ands, *ors)
-            else:  # 过滤器返回空
-                ors = (
-                    child.ref().emit_and(ctx.copy(), filter, caught)
-                    for filter, child in self.ors.items()
-                )
-                await asyncio.gather(*ors)
-
-        except Exception as e:  # 出错
-            caught.append(e)
-            err = {"error": e}
-            ands = (
-                child.ref().emit_and(ctx | err, filter, caught)
-                for filter, child in self.ands.items()
-            )
-            ors = (
-                child.ref().emit_or(ctx | err, caught) for child in self.ors.values()
-            )
-            catches = (
-                child.ref().emit_and(ctx | err, filter, caught)
-                for filter, child in self.catches.items()
-            )
-            if await asyncio.gather(*catches):
-                caught.pop()
-            await asyncio.gather(*ands, *ors)
+        如果检测到错误，以 CATCH 传给 and/or 子节点，以 AND 传给 catch 子节点；
+        存在 catch 子节点时，错误视为已处理，不加入 caught。"""
+        await _run([(self, ctx, filter)], caught)
 
     async def emit_or(self, ctx: dict[str, Any], caught: list[Exception], /):
         """跳过自身过滤器，直接以 AND 传给 and 子节点。"""
-        ands = (
-            child.ref().emit_and(ctx.copy(), filter, caught)
-            for filter, child in self.ands.items()
-        )
-        await asyncio.gather(*ands)
+        await _run([(child, ctx, fl) for fl, child, _ in self.ands], caught)
 
     async def emit_catch(self, ctx: dict[str, Any], caught: list[Exception], /):
         """跳过自身过滤器，以 CATCH 传给 and/or 子节点，以 AND 传给 catch 子节点。"""
-        ands = (
-            child.ref().emit_catch(ctx.copy(), caught) for child in self.ands.values()
-        )
-        ors = (
-            child.ref().emit_catch(ctx.copy(), caught) for child in self.ors.values()
-        )
-        catches = (
-            child.ref().emit_and(ctx.copy(), filter, caught)
-            for filter, child in self.catches.items()
-        )
-        await asyncio.gather(*ands, *ors, *catches)
+        items: list[_Item] = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            stack += [child for _, child, _ in node.ands]
+            stack += [child for _, child, _ in node.ors]
+            items += [(child, ctx, fl) for fl, child, _ in node.catches]
+        await _run(items, caught)
+
+    def _forward(self, ctx: dict[str, Any], items: list[_Item], /) -> None:
+        """以 AND 传给 and 子节点，以 OR 传给 or 子节点（即跳过 or 子节点，以 AND 传给其 and 子节点）。"""
+        items += [(child, ctx, fl) for fl, child, _ in self.ands]
+        for _, child, _ in self.ors:
+            items += [(grandchild, ctx, fl) for fl, grandchild, _ in child.ands]
+
+    def _passed(
+        self, ctx: dict[str, Any], res: Optional[dict[str, Any]], items: list[_Item], /
+    ) -> None:
+        """过滤器正常返回后，将子节点加入 items。
+
+        `res` 不是字典时引发 `TypeError`，此时 items 不变。
+        """
+        if res is not None:  # 过滤器返回非空
+            if self.ands or self.ors:
+                # 空字典（例如类型检查通过）不产生新的一层，上下文原样向下传递。
+                if res or res.__class__ is not dict:
+                    ctx = LayeredCtx.layer(ctx, res)
+                self._forward(ctx, items)
+        else:  # 过滤器返回空
+            items += [(child, ctx, fl) for fl, child, _ in self.ors]
+
+    def _failed(
+        self,
+        ctx: dict[str, Any],
+        e: Exception,
+        items: list[_Item],
+        caught: list[Exception],
+        /,
+    ) -> None:
+        """过滤器出错后，记录异常并将子节点加入 items。"""
+        catches = self.catches
+        if not catches:  # 有 catch 子节点时，异常视为已处理
+            caught.append(e)
+        if self._leaf:  # 叶节点（通常是处理器）无需传播异常
+            return
+        err = LayeredCtx.layer(ctx, {"error": e})
+        items += [(child, err, fl) for fl, child, _ in catches]
+        self._forward(err, items)
 
 
-class Op(Enum):
+# 待执行的过滤器：(过滤器所在边指向的节点, 事件上下文, 过滤器)
+_Item = Tuple[SaniTree, Dict[str, Any], Filter]
+
+
+async def _run(
+    items: list[_Item],
+    caught: list[Exception],
+    contexts: Optional[list[Context]] = None,
+    /,
+) -> None:
+    """逐层执行过滤器，直到没有待执行的过滤器。
+
+    过滤器（包括异步过滤器）先在当前协程中直接执行。大多数异步过滤器不会挂起，
+    这时它与同步过滤器一样，子节点加入下一层继续执行，不需要额外的协程。
+    真正挂起了的过滤器则交给单独的协程，在完成后自行继续执行其子树，
+    不会阻塞其他分支的执行，其他分支也不必等待它。
+
+    `contexts` 与 `items` 一一对应，是各过滤器执行时所在的 contextvars 上下文；
+    省略时各自复制当前的上下文。
+    """
+    if contexts is None:
+        contexts = [copy_context() for _ in items]
+    pending: list[Awaitable[None]] = []
+    while items:
+        next_items: list[_Item] = []
+        next_contexts: list[Context] = []
+        for (node, ctx, filter), context in zip(items, contexts):
+            try:
+                if not filter.is_async:
+                    res = context.run(filter.sync_filter, ctx)  # type: ignore
+                else:
+                    coro = filter.filter(ctx)
+                    try:
+                        yielded = context.run(coro.send, None)
+                    except StopIteration as stop:
+                        res = stop.value
+                    else:
+                        pending.append(
+                            _finish(node, ctx, coro, yielded, context, caught)
+                        )
+                        continue
+                # 新的上下文层在 _passed 中创建，过滤器返回的不是字典时，同样作为出错处理。
+                node._passed(ctx, res, next_items)
+            except Exception as e:
+                node._failed(ctx, e, next_items, caught)
+            _inherit(context, len(next_items) - len(next_contexts), next_contexts)
+        items, contexts = next_items, next_contexts
+
+    if len(pending) == 1:
+        await pending[0]
+    elif pending:
+        await asyncio.gather(*pending)
+
+
+async def _finish(
+    node: SaniTree,
+    ctx: dict[str, Any],
+    coro: Coroutine[Any, Any, Any],
+    yielded: Any,
+    context: Context,
+    caught: list[Exception],
+    /,
+) -> None:
+    """等待挂起了的过滤器完成，再执行它的子树。"""
+    items: list[_Item] = []
+    try:
+        res = await _drive(coro, yielded, context)
+        node._passed(ctx, res, items)
+    except Exception as e:
+        node._failed(ctx, e, items, caught)
+    contexts: list[Context] = []
+    _inherit(context, len(items), contexts)
+    await _run(items, caught, contexts)
+
+
+def _inherit(context: Context, n: int, contexts: list[Context], /) -> None:
+    """为过滤器的 n 个子节点准备 contextvars 上下文。
+
+    子节点继承过滤器执行后的上下文，但彼此独立：第一个直接沿用（过滤器已经执行完毕），其余各自复制一份。
+    """
+    if n:
+        contexts.append(context)
+        contexts += [context.copy() for _ in range(n - 1)]
+
+
+async def eager_gather(*coros: Coroutine[Any, Any, Any]) -> None:
+    """并发等待一组协程，丢弃其结果。
+
+    与 `asyncio.gather` 不同，协程会先在当前任务中立即执行，直到第一次挂起。
+    大多数过滤器在执行中不会挂起，此时协程在这里就已完成，无需创建 Task，也不必经过事件循环；
+    只有真正挂起了的协程，才交给 `asyncio.gather` 继续调度。
+
+    与 `asyncio.gather` 一样，每个协程都在当前 contextvars 上下文的一份副本中执行，
+    对上下文变量的修改不会影响调用者与其他协程。
+    """
+    pending: list[Coroutine[Any, Any, Any]] = []
+    for i, coro in enumerate(coros):
+        context = copy_context()
+        try:
+            yielded = context.run(coro.send, None)
+        except StopIteration:
+            continue
+        except BaseException:
+            # 不留下从未等待过的协程。
+            for rest in coros[i + 1 :]:
+                rest.close()
+            for waiting in pending:
+                waiting.close()
+            raise
+        pending.append(_resume(coro, yielded, context))
+    if len(pending) == 1:
+        await pending[0]
+    elif pending:
+        await asyncio.gather(*pending)
+
+
+async def _resume(
+    coro: Coroutine[Any, Any, Any], yielded: Any, context: Context
+) -> Any:
+    """继续执行已经挂起过一次的协程。"""
+    return await _drive(coro, yielded, context)
+
+
+@types.coroutine
+def _drive(
+    coro: Coroutine[Any, Any, Any], yielded: Any, context: Context
+) -> Generator[Any, Any, Any]:
+    # 将协程挂起时交出的对象转交给外层的 Task，再把 Task 的回应转交回协程。
+    # 协程总是在 context 中继续执行，与在自己的 Task 中执行时一样。
+    while True:
+        try:
+            value = yield yielded
+        except BaseException as e:
+            try:
+                yielded = context.run(coro.throw, e)
+            except StopIteration as stop:
+                return stop.value
+        else:
+            try:
+                yielded = context.run(coro.send, value)
+            except StopIteration as stop:
+                return stop.value
+
+
+class Op(IntEnum):
     """（待补充）"""
 
-    AND = auto()
+    # 取值即 SaniTree._ch 中对应子节点表的下标。
+    AND = 0
     """（待补充）"""
-    OR = auto()
+    OR = 1
     """（待补充）"""
-    CATCH = auto()
+    CATCH = 2
     """（待补充）"""
 
 
 T = TypeVar("T")
 
 
-class CowRef(Generic[T]):
-    """Copy-on-Write 引用。"""
+class EdgeList(List[Tuple[Filter, T, bool]]):
+    """子节点表，元素为 `(过滤器, 子节点, 是否独占)`。
 
-    value: T
-    owned: bool
+    子节点可能在多棵树之间共享（Copy-on-Write），只有独占的子节点才能原地修改。
 
-    __slots__ = ("value", "owned")
+    一个节点的子节点通常很少，此时线性查找比字典查找更快，遍历也更快。
+    子节点数目超过 `INDEX_THRESHOLD` 时，再建立过滤器到下标的索引。
+    """
 
-    def __init__(self, value: T, owned: bool) -> None:
-        self.value = value
-        self.owned = owned
+    INDEX_THRESHOLD: ClassVar[int] = 4
 
-    def ref(self) -> T:
-        return self.value
+    positions: Optional[dict[Filter, int]]
 
-    def mut(self) -> CowRef[T]:
-        if self.owned:
-            return self
-        else:
-            return CowRef(cp.copy(self.value), True)
+    __slots__ = ("positions",)
 
-    def copy(self) -> CowRef[T]:
-        return CowRef(self.value, False)
+    def __init__(self, edges: Iterable[tuple[Filter, T, bool]] = (), /) -> None:
+        super().__init__(edges)
+        self.positions = None
+        if len(self) > self.INDEX_THRESHOLD:
+            self.positions = {fl: i for i, (fl, _, _) in enumerate(self)}
 
-    def __hash__(self) -> int:
-        return hash(self.value)
+    def find(self, filter: Filter) -> int:
+        """查找过滤器所在的下标，不存在时返回 -1。"""
+        positions = self.positions
+        if positions is not None:
+            return positions.get(filter, -1)
+        cls = type(filter)
+        for i, (fl, _, _) in enumerate(self):
+            # 先比较类型，免去不同类型的过滤器之间的 __eq__ 调用。
+            if fl is filter or (type(fl) is cls and fl == filter):
+                return i
+        return -1
+
+    def get(self, filter: Filter) -> Optional[T]:
+        """查找过滤器对应的子节点。"""
+        i = self.find(filter)
+        return self[i][1] if i >= 0 else None
+
+    def add(self, filter: Filter, child: T, owned: bool) -> None:
+        """添加一个子节点。调用者应保证过滤器不在表中。"""
+        self.append((filter, child, owned))
+        if self.positions is not None:
+            self.positions[filter] = len(self) - 1
+        elif len(self) > self.INDEX_THRESHOLD:
+            self.positions = {fl: i for i, (fl, _, _) in enumerate(self)}
+
+
+class LayeredCtx(dict):
+    """分层的事件上下文。
+
+    只保存本层相对于上层的修改，查找未命中时回退到上层。
+    事件上下文向下传递时以此代替字典合并，避免在每条边上复制整个上下文。
+
+    `LayeredCtx` 是 `dict` 的子类，读取操作的行为与合并后的字典一致。
+    它是只读的，任何修改操作都会引发 `TypeError`，因此可以放心地在过滤器之间共享，不必复制。
+    """
+
+    parent: Mapping[str, Any]
+
+    __slots__ = ("parent",)
+
+    def __init__(self, parent: Mapping[str, Any], overlay: dict[str, Any], /) -> None:
+        super().__init__(overlay)
+        self.parent = parent
+
+    @classmethod
+    def root(cls, event: Any) -> LayeredCtx:
+        """创建事件的初始上下文。
+
+        每个事件都要调用一次，因此绕过 `__init__`，直接写入，省去中间字典的创建与复制。
+        """
+        ctx = dict.__new__(cls)
+        dict.__setitem__(ctx, "event", event)
+        ctx.parent = _EMPTY
+        return ctx
+
+    @classmethod
+    def layer(cls, parent: Mapping[str, Any], overlay: dict[str, Any], /) -> LayeredCtx:
+        """与 `LayeredCtx(parent, overlay)` 相同，但绕过 `__init__`，供分派事件时使用。
+
+        `overlay` 通常是过滤器的返回值，不是字典时引发 `TypeError`。
+        """
+        if not isinstance(overlay, dict):
+            raise TypeError(f"过滤器应返回 dict 或 None，而不是 {type(overlay).__name__}")
+        ctx = dict.__new__(cls)
+        dict.update(ctx, overlay)
+        ctx.parent = parent
+        return ctx
+
+    def __missing__(self, key: str) -> Any:
+        # 各层都不可变，可以把从上层查到的值记在本层，下次（以及下层的查找）不必再逐层回退。
+        value = self.parent[key]
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return dict.__contains__(self, key) or key in self.parent
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        return self.parent.get(key, default)
+
+    def copy(self) -> dict[str, Any]:
+        """合并各层，得到等价的普通字典。"""
+        # 上层总是 dict、LayeredCtx 或 MappingProxyType，它们都有 copy 方法。
+        ctx: dict[str, Any] = self.parent.copy()  # type: ignore[attr-defined]
+        ctx.update(dict.items(self))
+        return ctx
 
     __copy__ = copy
+
+    def keys(self):
+        return self.copy().keys()
+
+    def values(self):
+        return self.copy().values()
+
+    def items(self):
+        return self.copy().items()
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self) -> int:
+        return len(self.copy())
+
+    def __eq__(self, other: object) -> bool:
+        return self.copy() == other
+
+    def __ne__(self, other: object) -> bool:
+        return self.copy() != other
+
+    def __or__(self, other: Any) -> Any:
+        return self.copy() | other
+
+    def __ror__(self, other: Any) -> Any:
+        return other | self.copy()
+
+    def __repr__(self) -> str:
+        return repr(self.copy())
+
+    def __reduce__(self) -> Any:
+        return dict, (self.copy(),)
+
+    def _readonly(self, *_: Any, **__: Any) -> Any:
+        raise TypeError("事件上下文是只读的，对它的修改应通过过滤器的返回值完成")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+_EMPTY: Mapping[str, Any] = types.MappingProxyType({})
@@ -1,68 +1,242 @@
+import builtins
+import dataclasses
+import dis
+import functools
+import inspect
 from dataclasses import dataclass
-from typing import Any, Awaitable, Callable, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+from weakref import WeakValueDictionary
 
-from sani.core import Filter
+from sani.core import Filter, SyncFilter
+
+
+def _cached_hash(self: Filter) -> int:
+    return self._hash  # type: ignore
+
+
+def _singleton_new(cls: Any, *_: Any, **__: Any) -> Any:
+    """无参数过滤器的 `__new__`：每个类只创建一个实例。
+
+    只对定义了它的内置类生效，子类（可能带有字段）照常创建新的实例。
+    """
+    if "__new__" not in cls.__dict__:
+        return object.__new__(cls)
+    try:
+        return cls.__dict__["_instance"]
+    except KeyError:
+        self = object.__new__(cls)
+        type.__setattr__(cls, "_instance", self)
+        return self
+
+
+def _singleton_reduce(self: Any) -> Any:
+    """复制或序列化时按字段重新构造，内置类因此仍得到同一个实例。"""
+    return type(self), tuple(
+        getattr(self, f.name) for f in dataclasses.fields(self) if f.init
+    )
 
 
 @dataclass(eq=True, frozen=True)
-class UnitFilter(Filter):
+class UnitFilter(SyncFilter):
     """单元过滤器。
 
     （待补充）
     """
 
-    __slots__ = ()
+    __slots__ = ("_hash",)
+
+    __new__ = _singleton_new  # type: ignore[assignment]
+    __reduce__ = _singleton_reduce
 
-    async def filter(self, _: dict[str, Any], /) -> Optional[dict[str, Any]]:
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_hash", hash(()))
+
+    __hash__ = _cached_hash
+
+    def sync_filter(self, _: dict[str, Any], /) -> Optional[dict[str, Any]]:
         return {}
 
 
+_MISSING: Any = object()
+
+
 @dataclass(eq=True, frozen=True)
-class TypeFilter(Filter):
-    """类型过滤器。"""
+class TypeFilter(SyncFilter):
+    """类型过滤器。
+
+    同一类型总是得到同一个实例，在 SaniTree 中查找时可以直接按同一性命中，
+    不必调用 `__eq__`。
+    """
 
     target_type: type
 
-    __slots__ = ("target_type",)
+    __slots__ = ("target_type", "_hash", "__weakref__")  # __weakref__ 用于驻留
 
-    async def filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
-        if isinstance(context["event"], self.target_type):
+    def __new__(cls, target_type: type = _MISSING) -> "TypeFilter":
+        if cls is not TypeFilter or target_type is _MISSING:  # 子类，或 copy/pickle
+            return super().__new__(cls)
+        try:
+            return _type_filters[target_type]
+        except KeyError:
+            filter = _type_filters[target_type] = super().__new__(cls)
+            return filter
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_hash", hash((self.target_type,)))
+
+    __hash__ = _cached_hash
+
+    def __reduce__(self) -> Any:
+        return type(self), (self.target_type,)
+
+    @staticmethod
+    def of(target_type: type) -> "TypeFilter":
+        """获取检查 `target_type` 的类型过滤器，与 `TypeFilter(target_type)` 相同。"""
+        return TypeFilter(target_type)
+
+    def sync_filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
+        event = context["event"]
+        # 精确匹配时跳过 isinstance 对 MRO 的查找。
+        if type(event) is self.target_type or isinstance(event, self.target_type):
             return {}
         else:
             return None
 
 
+_type_filters: "WeakValueDictionary[type, TypeFilter]" = WeakValueDictionary()
+
+
 @dataclass(eq=True, frozen=True)
 class FuncFilter(Filter):
-    """函数过滤器。"""
+    """函数过滤器。
+
+    `func` 可以是异步函数，也可以是普通函数。普通函数的返回值如果是可等待对象（例如包装了异步函数的装饰器或 lambda），
+    会被等待；否则直接作为结果，编译后的分派函数不会为它创建协程。
+    """
+
+    func: Callable[
+        [Dict[str, Any]],
+        Union[Awaitable[Optional[Dict[str, Any]]], Optional[Dict[str, Any]]],
+    ]
+
+    __slots__ = ("func", "_hash")
 
-    func: Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_hash", hash((self.func,)))
 
-    __slots__ = ("func",)
+    __hash__ = _cached_hash
 
     async def filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
-        return await self.func(context)
+        res = self.func(context)
+        if res is None or isinstance(res, dict):
+            return res
+        return await res  # type: ignore
+
+
+def _is_async_callable(func: Any) -> bool:
+    """判断函数的返回值是否需要等待。无法判断时视为需要。"""
+    while isinstance(func, functools.partial):
+        func = func.func
+    if inspect.iscoroutinefunction(func):
+        return True
+    if inspect.isfunction(func) or inspect.ismethod(func) or inspect.isbuiltin(func):
+        return False
+    call = getattr(type(func), "__call__", None)
+    return call is None or inspect.iscoroutinefunction(call)
 
 
 @dataclass(eq=True, frozen=True)
-class LambdaFilter(Filter):
-    """Lambda 过滤器。"""
+class LambdaFilter(SyncFilter):
+    """Lambda 过滤器。
+
+    形如 `lambda ctx: isinstance(ctx[key], T)` 的函数会被识别出来，直接在过滤器中检查，
+    不再调用函数本身。其中 `T` 必须是全局或内置的类型，在构造过滤器时查找。
+    """
 
     func: Callable[[Any], bool]
 
-    __slots__ = ("func",)
+    __slots__ = ("func", "_hash", "_isinstance")
 
-    async def filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_hash", hash((self.func,)))
+        object.__setattr__(self, "_isinstance", _match_isinstance(self.func))
+
+    __hash__ = _cached_hash
+
+    def sync_filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
+        spec = self._isinstance  # type: ignore
+        if spec is not None:
+            key, target_type = spec
+            value = context[key]
+            if type(value) is target_type or isinstance(value, target_type):
+                return {}
+            return None
         return {} if self.func(context) else None
 
 
+# 不影响语义的指令，在匹配时忽略。
+_NOISE_OPS = {"RESUME", "PRECALL", "PUSH_NULL", "CACHE", "NOP", "EXTENDED_ARG"}
+_ISINSTANCE_OPS = [
+    "LOAD_GLOBAL",
+    "LOAD_FAST",
+    "LOAD_CONST",
+    "BINARY_SUBSCR",
+    "LOAD_GLOBAL",
+]
+_CALL_2 = {("CALL", 2), ("CALL_FUNCTION", 2)}
+
+
+def _match_isinstance(func: Callable[..., Any]) -> Optional[Tuple[Any, type]]:
+    """识别 `lambda ctx: isinstance(ctx[key], T)`，返回 `(key, T)`；不能识别时返回 `None`。"""
+    code = getattr(func, "__code__", None)
+    if (
+        code is None
+        or code.co_argcount != 1
+        or code.co_kwonlyargcount
+        or code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS)
+        or getattr(func, "__defaults__", None)
+    ):
+        return None
+    try:
+        ops = [i for i in dis.get_instructions(code) if i.opname not in _NOISE_OPS]
+    except Exception:
+        return None
+    tail = [(i.opname, i.arg) for i in ops[5:]]
+    if (
+        [i.opname for i in ops[:5]] != _ISINSTANCE_OPS
+        or len(tail) != 2
+        or tail[0] not in _CALL_2
+        or tail[1][0] != "RETURN_VALUE"
+    ):
+        return None
+    if ops[0].argval != "isinstance" or ops[1].argval != code.co_varnames[0]:
+        return None
+
+    namespace: Dict[str, Any] = getattr(func, "__globals__", {})
+    if "isinstance" in namespace:
+        return None
+    name = ops[4].argval
+    target_type = namespace.get(name, getattr(builtins, name, None))
+    if not isinstance(target_type, type):
+        return None
+    return ops[2].argval, target_type
+
+
 @dataclass(eq=True, frozen=True)
-class RaiseFilter(Filter):
+class RaiseFilter(SyncFilter):
     """Raise 过滤器。"""
 
-    __slots__ = ()
+    __slots__ = ("_hash",)
 
-    async def filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
+    __new__ = _singleton_new  # type: ignore[assignment]
+    __reduce__ = _singleton_reduce
+
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "_hash", hash(()))
+
+    __hash__ = _cached_hash
+
+    def sync_filter(self, context: Dict[str, Any], /) -> Optional[Dict[str, Any]]:
         if "error" in context:
             raise context["error"]
         return None
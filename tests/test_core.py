@@ -1,8 +1,15 @@
-from typing import Set
+import asyncio
+import contextvars
+import copy
+import functools
+from dataclasses import dataclass
+from typing import List, Set
 
 import pytest
 
 from sani import *
+from sani.compiler import MAX_INLINE_DEPTH
+from sani.core import LayeredCtx
 from sani.filters import *
 
 
@@ -257,3 +264,708 @@ async def test_subtree():
     ev = None
     await sani.emit("123")
     assert ev == "1231"
+
+
+def test_layered_ctx():
+    """测试分层上下文与合并后的字典等价。"""
+    base = {"event": 1, "parsed": 2}
+    ctx = LayeredCtx(LayeredCtx(base, {"parsed": 3}), {"extra": 4})
+
+    assert ctx["event"] == 1
+    assert ctx["parsed"] == 3
+    assert ctx.get("extra") == 4
+    assert ctx.get("missing") is None
+    assert "event" in ctx and "missing" not in ctx
+    assert ctx == {"event": 1, "parsed": 3, "extra": 4}
+    assert dict(ctx) == {"event": 1, "parsed": 3, "extra": 4}
+    assert ctx | {"extra": 5} == {"event": 1, "parsed": 3, "extra": 5}
+    assert len(ctx) == 3
+    with pytest.raises(KeyError):
+        ctx["missing"]
+    with pytest.raises(TypeError):
+        ctx["event"] = 2
+    with pytest.raises(TypeError):
+        ctx.update(extra=5)
+    assert LayeredCtx.root("test") == {"event": "test"}
+    assert LayeredCtx.layer(ctx, {"parsed": 5}) == {"event": 1, "parsed": 5, "extra": 4}
+
+
+def test_copy_on_write():
+    """测试复制出的树在添加路径时不影响原树。"""
+    tree = SaniTree()
+    tree.add_path([(Op.AND, TypeFilter(str), None)])
+
+    copied = tree.copy()
+    copied.add_path([(Op.AND, TypeFilter(str), None), (Op.AND, TypeFilter(int), None)])
+
+    assert not tree.ands.get(TypeFilter(str)).ands
+    assert copied.ands.get(TypeFilter(str)).ands.get(TypeFilter(int))
+
+    branch = SaniTree()
+    tree.add_path([(Op.AND, TypeFilter(list), branch), (Op.AND, TypeFilter(int), None)])
+    assert not branch.ands
+    assert tree.ands.get(TypeFilter(list)).ands.get(TypeFilter(int))
+
+
+@pytest.mark.asyncio
+async def test_compile():
+    """测试编译结果与解释执行一致，且在添加路径后失效。"""
+    seen: List[Any] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx["event"])
+        return None
+
+    async def fail(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        raise ValueError(ctx["event"])
+
+    tree = SaniTree()
+    tree.add_path(
+        [
+            (Op.AND, TypeFilter(int), None),
+            (Op.OR, TypeFilter(str), None),
+            (Op.AND, FuncFilter(endpoint), None),
+        ]
+    )
+    tree.add_path([(Op.AND, FuncFilter(fail), None)])
+
+    compiled = tree.compile()
+    assert tree.compile() is compiled
+
+    for event in (1, "a", []):
+        caught_interp: List[Exception] = []
+        await tree.emit_root({"event": event}, caught_interp)
+        caught_compiled: List[Exception] = []
+        await compiled({"event": event}, caught_compiled)
+        assert [e.args for e in caught_interp] == [e.args for e in caught_compiled]
+    assert seen == [1, 1, "a", "a"]
+
+    tree.add_path(
+        [(Op.AND, TypeFilter(list), None), (Op.AND, FuncFilter(endpoint), None)]
+    )
+    assert tree.compile() is not compiled
+    await tree.compile()({"event": []}, [])
+    assert seen[-1] == []
+
+    # 很长的过滤器链：超过内联深度后应退回函数调用，编译时也不应超出递归深度限制
+    chain = [(Op.AND, LambdaFilter(lambda ctx, i=i: i >= 0), None) for i in range(1000)]
+    tree.add_path([*chain, (Op.AND, FuncFilter(endpoint), None)])
+    await tree.compile()({"event": "chain"}, [])
+    assert seen[-1] == "chain"
+
+
+def test_edge_list():
+    """测试子节点较多时建立索引。"""
+    tree = SaniTree()
+    types = [int, str, list, dict, set, tuple, bytes]
+    for t in types:
+        tree.add_path([(Op.AND, TypeFilter(t), None)])
+    tree.add_path([(Op.AND, TypeFilter(str), None), (Op.AND, TypeFilter(int), None)])
+
+    assert tree.ands.positions is not None
+    assert [fl for fl, _, _ in tree.ands] == [TypeFilter(t) for t in types]
+    assert tree.ands.get(TypeFilter(str)).ands.get(TypeFilter(int))
+    assert tree.ands.get(TypeFilter(float)) is None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_children():
+    """测试挂起的过滤器之间仍能并发执行。"""
+    first, second = asyncio.Event(), asyncio.Event()
+    done: List[str] = []
+
+    async def wait_first(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await first.wait()
+        second.set()
+        done.append("a")
+        return None
+
+    async def wait_second(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        first.set()
+        await second.wait()
+        done.append("b")
+        return None
+
+    tree = SaniTree()
+    tree.add_path([(Op.AND, FuncFilter(wait_first), None)])
+    tree.add_path([(Op.AND, FuncFilter(wait_second), None)])
+
+    await asyncio.wait_for(Sani(tree).emit(None), 1)
+    assert sorted(done) == ["a", "b"]
+
+    first.clear(), second.clear()
+    await asyncio.wait_for(tree.emit_root({"event": None}, []), 1)
+    assert len(done) == 4
+
+
+@pytest.mark.asyncio
+async def test_cross_branch_dependency():
+    """测试不同深度的分支之间存在依赖时不会死锁。"""
+    flag = asyncio.Event()
+    done: List[str] = []
+
+    async def wait_flag(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await flag.wait()
+        done.append("wait")
+        return None
+
+    async def parse(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await asyncio.sleep(0)
+        return {"parsed": True}
+
+    def set_flag(ctx: Dict[str, Any]) -> None:
+        assert ctx["parsed"]
+        flag.set()
+        done.append("set")
+
+    tree = SaniTree()
+    tree.add_path([(Op.AND, FuncFilter(wait_flag), None)])
+    tree.add_path(
+        [
+            (Op.AND, FuncFilter(parse), None),
+            (Op.AND, FuncFilter(set_flag), None),
+        ]
+    )
+
+    await asyncio.wait_for(tree.emit_root(LayeredCtx.root(None), []), 1)
+    assert done == ["set", "wait"]
+
+    flag.clear()
+    await asyncio.wait_for(Sani(tree).emit(None), 1)
+    assert done == ["set", "wait"] * 2
+
+
+def test_type_filter_of():
+    """测试类型过滤器的驻留。"""
+    assert TypeFilter.of(int) is TypeFilter.of(int)
+    assert TypeFilter.of(int) == TypeFilter(int)
+    assert TypeFilter.of(int) is not TypeFilter.of(str)
+    assert TypeFilter(int) is TypeFilter.of(int)
+    assert RaiseFilter() is RaiseFilter()
+    assert UnitFilter() is UnitFilter()
+    assert copy.deepcopy(TypeFilter(int)) is TypeFilter(int)
+    assert not hasattr(TypeFilter(int), "__dict__")
+    assert not hasattr(RaiseFilter(), "__dict__")
+
+
+def test_singleton_subclass():
+    """测试带有字段的子类不会被当作单例。"""
+
+    @dataclass(frozen=True)
+    class Tagged(UnitFilter):
+        tag: str
+
+    a, b = Tagged("a"), Tagged(tag="b")
+    assert a is not b
+    assert (a.tag, b.tag) == ("a", "b")
+    assert a != b and a == Tagged("a")
+    assert copy.deepcopy(a) == a
+    assert copy.deepcopy(UnitFilter()) is UnitFilter()
+    assert a.sync_filter({}) == {}
+
+
+@pytest.mark.asyncio
+async def test_empty_overlay():
+    """测试过滤器返回空字典时，上下文原样向下传递。"""
+    seen: List[Dict[str, Any]] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx)
+        return None
+
+    tree = SaniTree()
+    tree.add_path(
+        [(Op.AND, TypeFilter(str), None), (Op.AND, FuncFilter(endpoint), None)]
+    )
+
+    ctx = LayeredCtx.root("test")
+    await tree.compile()(ctx, [])
+    await tree.emit_root(ctx, [])
+    assert seen[0] is ctx and seen[1] is ctx
+
+
+@pytest.mark.asyncio
+async def test_catch_handled():
+    """测试存在 catch 子节点时，异常视为已处理。"""
+    caught: List[Exception] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        raise ValueError(ctx["event"])
+
+    async def catcher(err: Exception):
+        caught.append(err)
+
+    tree = SaniTree()
+    tree.add_path(
+        [
+            (Op.AND, FuncFilter(endpoint), None),
+            (Op.CATCH, LambdaFilter(lambda ctx: False), None),
+        ]
+    )
+    await Sani(tree, catch=catcher).emit("test")
+    assert caught == []
+
+    interp: List[Exception] = []
+    await tree.emit_root(LayeredCtx.root("test"), interp)
+    assert interp == []
+
+
+@pytest.mark.asyncio
+async def test_caught_reuse():
+    """测试多次触发事件时，异常不会串到其他事件中。"""
+    caught: List[Exception] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await asyncio.sleep(0)
+        raise ValueError(ctx["event"])
+
+    async def catcher(err: Exception):
+        caught.append(err)
+
+    tree = SaniTree()
+    tree.add_path([(Op.AND, FuncFilter(endpoint), None)])
+    sani = Sani(tree, catch=catcher)
+    await sani.emit(1)
+    await asyncio.gather(sani.emit(2), sani.emit(3))
+    await sani.emit(4)
+    assert sorted(err.args[0] for err in caught) == [1, 2, 3, 4]
+
+
+def test_is_async():
+    """测试过滤器的同步/异步标记。"""
+
+    assert FuncFilter.is_async
+    assert not TypeFilter.is_async
+    assert not LambdaFilter.is_async
+
+    class Override(UnitFilter):
+        async def filter(self, context):
+            return {}
+
+    assert Override.is_async
+
+
+@pytest.mark.asyncio
+async def test_type_index():
+    """测试按事件类型分派时，子类、抽象基类与 `__class__` 代理的处理。"""
+    from collections.abc import Sized
+
+    got: List[str] = []
+
+    def handler(tag: str) -> FuncFilter:
+        async def handle(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+            got.append(tag)
+            return None
+
+        return FuncFilter(handle)
+
+    tree = SaniTree()
+    for t in (int, bool, str, Sized):
+        tree.add_path(
+            [(Op.AND, TypeFilter(t), None), (Op.AND, handler(t.__name__), None)]
+        )
+
+    class Proxy:
+        __class__ = str  # type: ignore
+
+    sani = Sani(tree)
+    for event, expected in [
+        (1, ["int"]),
+        (True, ["int", "bool"]),
+        ("s", ["str", "Sized"]),
+        ([], ["Sized"]),
+        (Proxy(), ["str", "Sized"]),
+        (None, []),
+    ]:
+        got.clear()
+        await sani.emit(event)
+        assert got == expected
+
+    # 动态创建的事件类型不会一直留在缓存中
+    import gc
+    import weakref
+
+    refs = []
+    for i in range(1000):
+        event_type = type(f"Event{i}", (int,), {})
+        refs.append(weakref.ref(event_type))
+        got.clear()
+        await sani.emit(event_type(i))
+        assert got == ["int"]
+    del event_type
+    gc.collect()
+    assert sum(ref() is not None for ref in refs) < 500
+
+
+def test_lambda_isinstance():
+    """测试 LambdaFilter 对 isinstance 检查的识别。"""
+    from sani.filters import _match_isinstance
+
+    assert _match_isinstance(lambda ctx: isinstance(ctx["error"], RuntimeError)) == (
+        "error",
+        RuntimeError,
+    )
+    assert _match_isinstance(lambda ctx: isinstance(ctx["event"], TypeFilter)) == (
+        "event",
+        TypeFilter,
+    )
+    assert _match_isinstance(lambda ctx: not isinstance(ctx["event"], int)) is None
+    assert _match_isinstance(lambda ctx: isinstance(ctx, dict)) is None
+    assert _match_isinstance(lambda ctx: isinstance(ctx["event"], (int, str))) is None
+
+    f = LambdaFilter(lambda ctx: isinstance(ctx["error"], LookupError))
+    assert f.sync_filter(LayeredCtx.root(None) | {"error": KeyError()}) == {}
+    assert f.sync_filter({"error": ValueError()}) is None
+
+
+@pytest.mark.asyncio
+async def test_sync_func():
+    """测试普通函数作为过滤器。"""
+    seen: List[Any] = []
+
+    def parse(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        return {"parsed": ctx["event"] * 2}
+
+    def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx["parsed"])
+        return None
+
+    tree = SaniTree()
+    tree.add_path(
+        [
+            (Op.AND, TypeFilter(int), None),
+            (Op.AND, FuncFilter(parse), None),
+            (Op.AND, FuncFilter(endpoint), None),
+        ]
+    )
+    await Sani(tree).emit(21)
+    await tree.emit_root(LayeredCtx.root(1), [])
+    assert seen == [42, 2]
+
+
+@pytest.mark.asyncio
+async def test_sync_catch():
+    """测试普通函数作为 catch。"""
+    caught: List[Exception] = []
+
+    def fail(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        raise ValueError(ctx["event"])
+
+    tree = SaniTree()
+    tree.add_path([(Op.AND, FuncFilter(fail), None)])
+    await Sani(tree, catch=caught.append).emit(1)
+
+    async def catcher(err: Exception):
+        caught.append(err)
+
+    await Sani(tree, catch=lambda err: catcher(err)).emit(2)
+    assert [err.args[0] for err in caught] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_reraise_traceback():
+    """测试经 RaiseFilter 交给 catch 的异常，其 traceback 不包含重新抛出的过程。"""
+    caught: List[Exception] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        raise RuntimeError(ctx["event"])
+
+    tree = SaniTree()
+    tree.add_path(
+        [
+            (Op.AND, FuncFilter(endpoint), None),
+            (Op.CATCH, LambdaFilter(lambda ctx: False), None),
+            (Op.OR, RaiseFilter(), None),
+        ]
+    )
+    await Sani(tree, catch=caught.append).emit("test")
+
+    (err,) = caught
+    tb = err.__traceback__
+    names = []
+    while tb is not None:
+        names.append(tb.tb_frame.f_code.co_name)
+        tb = tb.tb_next
+    assert names[-1] == "endpoint"
+    assert "sync_filter" not in names
+
+
+@pytest.mark.asyncio
+async def test_compile_event():
+    """测试直接接收事件的分派函数。"""
+    seen: List[Any] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx["event"])
+        return None
+
+    tree = SaniTree()
+    await tree.compile_event()(1, [])
+    for t in (int, str):
+        tree.add_path(
+            [(Op.AND, TypeFilter(t), None), (Op.AND, FuncFilter(endpoint), None)]
+        )
+
+    emit = tree.compile_event()
+    for event in (1, "a", [], None, True):
+        await emit(event, [])
+    assert seen == [1, "a", True]
+
+    tree.add_path([(Op.AND, FuncFilter(endpoint), None)])
+    await tree.compile_event()([], [])
+    assert seen[-1] == []
+
+
+@pytest.mark.asyncio
+async def test_emit_many():
+    """测试批量触发事件。"""
+    seen: List[Any] = []
+    caught: List[Exception] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if ctx["event"] == "bad":
+            raise ValueError(len(seen))
+        seen.append(ctx["event"])
+        return None
+
+    tree = SaniTree()
+    tree.add_path(
+        [(Op.AND, TypeFilter(str), None), (Op.AND, FuncFilter(endpoint), None)]
+    )
+    tree.add_path(
+        [(Op.AND, TypeFilter(int), None), (Op.AND, FuncFilter(endpoint), None)]
+    )
+
+    await Sani(tree, catch=caught.append).emit_many(["a", 1, [], "bad", 2, "b"])
+    assert seen == ["a", 1, 2, "b"]
+    assert [err.args[0] for err in caught] == [2]
+
+
+@pytest.mark.asyncio
+async def test_leaf_type_filter():
+    """测试以类型过滤器结尾的路径可以正常编译。"""
+    seen: List[Any] = []
+
+    async def endpoint(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx["event"])
+        return None
+
+    # 并列的叶子类型过滤器（按类型索引）
+    indexed = SaniTree()
+    indexed.add_path([(Op.AND, TypeFilter(int), None)])
+    indexed.add_path([(Op.AND, TypeFilter(str), None)])
+    indexed.add_path(
+        [(Op.AND, TypeFilter(list), None), (Op.AND, FuncFilter(endpoint), None)]
+    )
+
+    # 叶子类型过滤器与其他路径并列（并发等待）
+    sibling = SaniTree()
+    sibling.add_path([(Op.AND, TypeFilter(int), None)])
+    sibling.add_path([(Op.AND, FuncFilter(endpoint), None)])
+
+    # 超过内联深度的类型过滤器链
+    chain = SaniTree()
+    chain.add_path([(Op.AND, TypeFilter(object), None)] * (MAX_INLINE_DEPTH + 1))
+    chain.add_path(
+        [(Op.AND, TypeFilter(object), None)] * (MAX_INLINE_DEPTH + 1)
+        + [(Op.AND, FuncFilter(endpoint), None)]
+    )
+
+    for tree in (indexed, sibling, chain):
+        sani = Sani(tree)
+        for event in (1, "a", []):
+            await sani.emit(event)
+    assert seen == [[], 1, "a", [], 1, "a", []]
+
+
+@pytest.mark.asyncio
+async def test_wrapped_async_func():
+    """测试返回可等待对象的普通函数（装饰器、lambda）作为过滤器时，结果会被等待。"""
+    seen: List[Any] = []
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(ctx):
+            return func(ctx)
+
+        return wrapper
+
+    @decorator
+    async def parse(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await asyncio.sleep(0)
+        return {"parsed": ctx["event"] * 2}
+
+    async def handler(ctx: Dict[str, Any], tag: str) -> Optional[Dict[str, Any]]:
+        await asyncio.sleep(0)
+        seen.append((tag, ctx["parsed"]))
+        return None
+
+    tree = SaniTree()
+    tree.add_path(
+        [
+            (Op.AND, FuncFilter(parse), None),
+            (Op.AND, FuncFilter(lambda ctx: handler(ctx, "tag")), None),
+        ]
+    )
+    caught: List[Exception] = []
+    await Sani(tree, catch=caught.append).emit(1)
+    await tree.emit_root(LayeredCtx.root(2), caught)
+    assert seen == [("tag", 2), ("tag", 4)]
+    assert caught == []
+
+
+@pytest.mark.asyncio
+async def test_non_dict_result():
+    """测试过滤器返回的不是字典时，错误交给 catch，而不是从 emit 中抛出。"""
+    seen: List[Any] = []
+
+    async def bad(ctx: Dict[str, Any]) -> Any:
+        return "ok"
+
+    async def handler(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(ctx["event"])
+        return None
+
+    tree = SaniTree()
+    tree.add_path(
+        [(Op.AND, FuncFilter(bad), None), (Op.AND, FuncFilter(handler), None)]
+    )
+    caught: List[Exception] = []
+    await Sani(tree, catch=caught.append).emit(1)
+    assert [type(e) for e in caught] == [TypeError]
+    assert seen == [1]  # 出错时仍以 AND 传给 and 子节点，与其他异常相同
+
+    caught.clear()
+    await tree.emit_root(LayeredCtx.root(2), caught)
+    assert [type(e) for e in caught] == [TypeError]
+    assert seen == [1, 2]
+
+    async def slow_bad(ctx: Dict[str, Any]) -> Any:
+        await asyncio.sleep(0)
+        return "ok"
+
+    tree = SaniTree()
+    tree.add_path(
+        [(Op.AND, FuncFilter(slow_bad), None), (Op.AND, FuncFilter(handler), None)]
+    )
+    caught.clear()
+    await tree.emit_root(LayeredCtx.root(3), caught)
+    assert [type(e) for e in caught] == [TypeError]
+    assert seen == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_context_isolation():
+    """测试过滤器对上下文变量的修改只影响其子节点，不影响兄弟节点与调用者。"""
+    var: contextvars.ContextVar[str] = contextvars.ContextVar("var", default="unset")
+    seen: List[Tuple[str, str]] = []
+
+    def parse(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        var.set("parsed")
+        return {}
+
+    async def handler(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(("handler", var.get()))
+        var.set("handler")
+        return None
+
+    async def slow(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        await asyncio.sleep(0)
+        seen.append(("slow", var.get()))
+        var.set("slow")
+        await asyncio.sleep(0)
+        seen.append(("slow", var.get()))
+        return None
+
+    def sibling(ctx: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        seen.append(("sibling", var.get()))
+        var.set("sibling")
+        return None
+
+    chain = SaniTree()
+    chain.add_path(
+        [(Op.AND, FuncFilter(parse), None), (Op.AND, FuncFilter(handler), None)]
+    )
+    fork = chain.copy()
+    fork.add_path([(Op.AND, FuncFilter(slow), None)])
+    fork.add_path([(Op.AND, FuncFilter(sibling), None)])
+    fork.add_path(
+        [(Op.AND, FuncFilter(parse), None), (Op.AND, FuncFilter(sibling), None)]
+    )
+
+    for tree in (chain, fork):
+        for emit in (
+            Sani(tree).emit,
+            lambda ev: tree.emit_root(LayeredCtx.root(ev), []),
+        ):
+            seen.clear()
+            await emit(None)
+            assert var.get() == "unset"
+            assert ("handler", "parsed") in seen
+            assert all(v in ("parsed", "unset") for who, v in seen if who != "slow")
+
+    assert sorted(seen) == [
+        ("handler", "parsed"),
+        ("sibling", "parsed"),
+        ("sibling", "unset"),
+        ("slow", "slow"),
+        ("slow", "unset"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_alternating_path_size(monkeypatch: pytest.MonkeyPatch):
+    """测试 AND 与 OR 交替的路径，编译得到的代码量与纯 AND 路径相当，而不随深度成倍增长。"""
+    import builtins
+
+    import sani.compiler
+
+    sizes: List[int] = []
+
+    def record(source: str, *args: Any) -> Any:
+        sizes.append(len(source))
+        return builtins.compile(source, *args)
+
+    monkeypatch.setattr(sani.compiler, "compile", record, raising=False)
+
+    trees = []
+    for alternate in (False, True):
+        tree = SaniTree()
+        tree.add_path(
+            [
+                (
+                    Op.OR if alternate and i % 2 else Op.AND,
+                    LambdaFilter(lambda ctx, i=i: ctx["event"] % (i + 2)),
+                    None,
+                )
+                for i in range(40)
+            ]
+        )
+        tree.compile()
+        trees.append(tree)
+    assert sizes[1] < 2 * sizes[0]
+
+    for event in range(12):
+        caught: List[Exception] = []
+        await trees[1].compile()({"event": event}, caught)
+        await trees[1].emit_root({"event": event}, caught)
+        assert caught == []
+
+
+def test_compile_cache_per_tree():
+    """测试修改其他的树不会使编译结果失效，修改共享的节点则会。"""
+    tree = SaniTree()
+    tree.add_path([(Op.AND, TypeFilter(int), None), (Op.AND, TypeFilter(str), None)])
+    compiled = tree.compile()
+
+    other = SaniTree()
+    for i in range(10):
+        other.add_path([(Op.AND, LambdaFilter(lambda ctx, i=i: i), None)])
+        assert tree.compile() is compiled
+
+    # 复制出的树与原树共享节点，原树原地修改共享的节点后，两者的编译结果都应失效。
+    copied = tree.copy()
+    copied_compiled = copied.compile()
+    tree.add_path([(Op.AND, TypeFilter(int), None), (Op.AND, TypeFilter(list), None)])
+    assert tree.compile() is not compiled
+    assert copied.compile() is not copied_compiled